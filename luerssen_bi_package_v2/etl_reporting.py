@@ -7,16 +7,22 @@ Features:
 - Reads additional sources: mitarbeiter.csv, lieferanten.xlsx
 - ETL transformations, KPI computation
 - Data quality checks
-- Writes KPI table to DW (SQLite), and exports CSV, Excel, Parquet
+- Writes KPI table to DW (Parquet, or SQL via DW_FORMAT=sql), and exports CSV, Excel, Parquet
 - Generates interactive HTML dashboard (plotly.graph_objects)
 - Uses config.json for configuration
 """
 import os
-from datetime import datetime, timedelta
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 import numpy as np
-from sqlalchemy import create_engine, text
+import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.pool import QueuePool
 import json
 
 # Load config
@@ -26,6 +32,8 @@ with open(CONFIG_PATH, "r", encoding="utf-8") as f:
 
 SOURCE_DB_URI = os.environ.get("SOURCE_DB_URI", cfg.get("SOURCE_DB_URI", "sqlite:///source_demo.db"))
 DW_DB_URI = os.environ.get("DW_DB_URI", cfg.get("DW_DB_URI", "sqlite:///dw_demo.db"))
+DW_FORMAT = os.environ.get("DW_FORMAT", cfg.get("DW_FORMAT", "parquet"))  # "parquet" or "sql" (DW_DB_URI)
+DW_PARQUET = os.environ.get("DW_PARQUET", cfg.get("DW_PARQUET", "dw_kpis.parquet"))
 MITARBEITER_CSV = cfg.get("MITARBEITER_CSV", "mitarbeiter.csv")
 LIEFERANTEN_XLSX = cfg.get("LIEFERANTEN_XLSX", "lieferanten.xlsx")
 DASHBOARD_HTML = cfg.get("DASHBOARD_HTML", "outputs/dashboard.html")
@@ -36,25 +44,27 @@ PARQUET_EXPORT = cfg.get("PARQUET_EXPORT", "outputs/kpi_export.parquet")
 # ---------------------------
 # Demo data creation (if needed)
 # ---------------------------
-def create_demo_source_db(engine):
+def build_demo_data():
     rng = np.random.default_rng(42)
     n_orders = 500
-    start_date = datetime(2024, 1, 1)
+    start_date = np.datetime64("2024-01-01", "D")
+    site = rng.choice(["Bremen", "Hamburg", "Rendsburg"], size=n_orders, p=[0.5,0.3,0.2])
+    created_at = start_date + rng.integers(0, 600, n_orders).astype("timedelta64[D]")
+    cost = rng.normal(10000, 2000, n_orders).round(2)
+    mask = rng.random(n_orders) < 0.8
+    completed_at = created_at + rng.integers(10, 120, n_orders).astype("timedelta64[D]")
+    completed_at[~mask] = np.datetime64("NaT")
     orders = pd.DataFrame({
         "order_id": np.arange(1, n_orders+1),
-        "site": rng.choice(["Bremen", "Hamburg", "Rendsburg"], size=n_orders, p=[0.5,0.3,0.2]),
-        "created_at": [start_date + timedelta(days=int(x)) for x in rng.integers(0, 600, n_orders)],
-        "completed_at": [None]*n_orders,
-        "cost": rng.normal(10000, 2000, n_orders).round(2)
+        "site": pd.Categorical(site),
+        "created_at": created_at,
+        "completed_at": completed_at,
+        "cost": cost
     })
-    for i in orders.sample(frac=0.8, random_state=1).index:
-        lead = int(rng.integers(10, 120))
-        orders.at[i, "completed_at"] = (orders.at[i, "created_at"] + timedelta(days=lead)).strftime("%Y-%m-%d")
-    orders["created_at"] = orders["created_at"].dt.strftime("%Y-%m-%d")
     production = pd.DataFrame({
         "prod_id": np.arange(1, 301),
-        "site": rng.choice(["Bremen", "Hamburg", "Rendsburg"], size=300),
-        "start_date": [(start_date + timedelta(days=int(x))).strftime("%Y-%m-%d") for x in rng.integers(0, 600, 300)],
+        "site": pd.Categorical(rng.choice(["Bremen", "Hamburg", "Rendsburg"], size=300)),
+        "start_date": start_date + rng.integers(0, 600, 300).astype("timedelta64[D]"),
         "percent_complete": rng.integers(0, 101, 300),
         "defects": rng.poisson(0.8, 300)
     })
@@ -63,6 +73,10 @@ def create_demo_source_db(engine):
         "name": ["Team A", "Team B", "Team C"],
         "site": ["Bremen", "Hamburg", "Rendsburg"]
     })
+    return orders, production, employees
+
+def create_demo_source_db(engine):
+    orders, production, employees = build_demo_data()
     orders.to_sql("orders", engine, if_exists="replace", index=False)
     production.to_sql("production", engine, if_exists="replace", index=False)
     employees.to_sql("employees", engine, if_exists="replace", index=False)
@@ -92,47 +106,72 @@ def read_additional_sources():
 # Extract
 # ---------------------------
 def extract_data(engine):
-    orders = pd.read_sql("SELECT * FROM orders", con=engine)
-    production = pd.read_sql("SELECT * FROM production", con=engine)
-    employees = pd.read_sql("SELECT * FROM employees", con=engine)
+    queries = [
+        ("SELECT * FROM orders", ["created_at", "completed_at"]),
+        ("SELECT * FROM production", ["start_date"]),
+        ("SELECT * FROM employees", None),
+    ]
+    def read(query):
+        sql, parse_dates = query
+        return pd.read_sql(sql, con=engine, dtype_backend="pyarrow", parse_dates=parse_dates)
+    # independent tables: read in parallel, each thread checks out its own pooled connection.
+    # Only with a QueuePool: with a SingletonThreadPool (e.g. in-memory sqlite://) each thread would see its own empty DB.
+    if isinstance(engine.pool, QueuePool):
+        with ThreadPoolExecutor(max_workers=3) as ex:
+            orders, production, employees = ex.map(read, queries)
+    else:
+        orders, production, employees = map(read, queries)
+    orders['site'] = orders['site'].astype('category')
+    production['site'] = production['site'].astype('category')
     return orders, production, employees
 
 # ---------------------------
 # Transform / KPI
 # ---------------------------
+def _year_month_key(col):
+    # Int32 month key year*12 + (month-1): cheaper to hash than "YYYY-MM" strings
+    return (pl.col(col).dt.year().cast(pl.Int32) * 12 + pl.col(col).dt.month().cast(pl.Int32) - 1).alias("year_month_key")
+
 def transform_data(orders, production, mit, liefer):
-    orders = orders.copy()
-    orders['created_at'] = pd.to_datetime(orders['created_at'])
-    orders['completed_at'] = pd.to_datetime(orders['completed_at'], errors='coerce')
-    orders['lead_days'] = (orders['completed_at'] - orders['created_at']).dt.days
-    orders['is_completed'] = orders['completed_at'].notna().astype(int)
-    orders['year_month'] = orders['created_at'].dt.to_period('M').astype(str)
-    kpi_orders = orders.groupby(['site', 'year_month']).agg(
-        orders_count=('order_id', 'count'),
-        completed_count=('is_completed', 'sum'),
-        avg_lead_days=('lead_days', 'mean'),
-        cost_total=('cost', 'sum')
-    ).reset_index()
-    kpi_orders['avg_lead_days'] = kpi_orders['avg_lead_days'].fillna(0).round(2)
-    production = production.copy()
-    production['start_date'] = pd.to_datetime(production['start_date'])
-    production['year_month'] = production['start_date'].dt.to_period('M').astype(str)
-    kpi_prod = production.groupby(['site', 'year_month']).agg(
-        avg_percent_complete=('percent_complete', 'mean'),
-        defects_total=('defects', 'sum'),
-        production_count=('prod_id', 'count')
-    ).reset_index()
-    kpi_prod['avg_percent_complete'] = kpi_prod['avg_percent_complete'].round(2)
-    kpi = pd.merge(kpi_orders, kpi_prod, how='outer', on=['site', 'year_month']).fillna(0)
-    kpi['completion_rate'] = (kpi['completed_count'] / kpi['orders_count']).replace([np.inf, -np.inf], 0).fillna(0).round(3)
-    try:
-        kpi['year_month_date'] = pd.to_datetime(kpi['year_month'] + '-01')
-    except Exception:
-        kpi['year_month_date'] = pd.NaT
+    lf_orders = pl.from_pandas(orders).lazy().with_columns([
+        pl.col("site").cast(pl.Categorical),
+        _year_month_key("created_at"),
+    ])
+    kpi_orders = lf_orders.group_by(["site", "year_month_key"]).agg([
+        pl.len().alias("orders_count"),
+        pl.col("completed_at").is_not_null().sum().alias("completed_count"),
+        (pl.col("completed_at") - pl.col("created_at")).dt.total_days().mean().fill_null(0).round(2).alias("avg_lead_days"),
+        pl.col("cost").sum().round(2).alias("cost_total"),
+    ])
+    lf_prod = pl.from_pandas(production).lazy().with_columns([
+        pl.col("site").cast(pl.Categorical),
+        _year_month_key("start_date"),
+    ])
+    kpi_prod = lf_prod.group_by(["site", "year_month_key"]).agg([
+        pl.col("percent_complete").mean().round(2).alias("avg_percent_complete"),
+        pl.col("defects").sum().alias("defects_total"),
+        pl.len().alias("production_count"),
+    ])
+    kpi = (
+        kpi_orders.join(kpi_prod, on=["site", "year_month_key"], how="full", coalesce=True)
+        .with_columns(pl.exclude("site", "year_month_key").fill_null(0))
+        .sort(["site", "year_month_key"])
+        .with_columns(pl.date(pl.col("year_month_key") // 12, pl.col("year_month_key") % 12 + 1, 1).alias("year_month_date"))
+        .select("site", pl.col("year_month_date").dt.strftime("%Y-%m").alias("year_month"),
+                pl.exclude("site", "year_month_key"))
+        .collect(engine="streaming")
+        .to_pandas()
+    )
+    completed = kpi['completed_count'].to_numpy(dtype=np.float64)
+    ordered = kpi['orders_count'].to_numpy(dtype=np.float64)
+    rate = np.zeros_like(completed)
+    np.divide(completed, ordered, out=rate, where=ordered > 0)
+    kpi['completion_rate'] = np.round(rate, 3)
+    kpi['year_month_date'] = kpi.pop('year_month_date')  # keep column layout: after completion_rate
     kpi['generated_at'] = pd.Timestamp.now()
     if not mit.empty and 'site' in mit.columns:
-        emp_counts = mit.groupby('site').size().reset_index(name='employee_count')
-        kpi = kpi.merge(emp_counts, on='site', how='left').fillna({'employee_count':0})
+        emp_counts = mit.groupby('site').size()
+        kpi['employee_count'] = kpi['site'].astype(str).map(emp_counts).fillna(0).astype('int64')
     else:
         kpi['employee_count'] = 0
     if not liefer.empty:
@@ -141,20 +180,30 @@ def transform_data(orders, production, mit, liefer):
         kpi['supplier_count'] = 0
     return kpi
 
+def downcast_kpis(kpi):
+    # counts fit int32; float KPIs stay float64 so their rounded values survive widening
+    return kpi.astype({
+        'orders_count': 'int32', 'completed_count': 'int32', 'defects_total': 'int32', 'production_count': 'int32',
+    })
+
 # ---------------------------
 # Data Quality Checks
 # ---------------------------
 def data_quality_checks(orders, production):
     issues = []
-    if orders['order_id'].isnull().any():
+    order_id = pa.array(orders['order_id'])
+    cost_min = pc.min(pa.array(orders['cost'])).as_py()
+    pct = pc.min_max(pa.array(production['percent_complete']))
+    pct_min, pct_max = pct['min'].as_py(), pct['max'].as_py()
+    if order_id.null_count:
         issues.append("Nulls in orders.order_id")
-    if orders['created_at'].isnull().any():
+    if pa.array(orders['created_at']).null_count:
         issues.append("Nulls in orders.created_at")
-    if orders['order_id'].duplicated().any():
+    if pc.count_distinct(order_id, mode='all').as_py() < len(order_id):
         issues.append("Duplicated order_id in orders")
-    if (orders['cost'] < 0).any():
+    if cost_min is not None and cost_min < 0:
         issues.append("Negative cost values found")
-    if production['percent_complete'].lt(0).any() or production['percent_complete'].gt(100).any():
+    if (pct_min is not None and pct_min < 0) or (pct_max is not None and pct_max > 100):
         issues.append("percent_complete out of range 0-100")
     return issues
 
@@ -162,14 +211,32 @@ def data_quality_checks(orders, production):
 # Load/Exports
 # ---------------------------
 def load_to_dw(engine_dw, kpi_df):
-    kpi_df.to_sql("kpis", engine_dw, if_exists="replace", index=False)
+    if DW_FORMAT == "parquet":
+        kpi_df.to_parquet(DW_PARQUET, engine="pyarrow", compression="zstd", index=False)
+        print(f"KPI-Tabelle in DW geschrieben: {DW_PARQUET} (rows={len(kpi_df)})")
+        return
+    with engine_dw.begin() as conn:
+        if engine_dw.dialect.name == "sqlite":
+            conn.exec_driver_sql("PRAGMA synchronous=OFF")
+            conn.exec_driver_sql("PRAGMA journal_mode=MEMORY")
+        # stay under ~2000 bind parameters per INSERT (MS SQL allows 2100)
+        chunksize = max(1, 2000 // len(kpi_df.columns))
+        kpi_df.to_sql("kpis", conn, if_exists="replace", index=False, method="multi", chunksize=chunksize)
     print(f"KPI-Tabelle in DW geschrieben (rows={len(kpi_df)})")
 
+def _csv_table(df):
+    # keep DataFrame.to_csv date formats: month without time part, timestamps with microseconds
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for name, typ in (("year_month_date", pa.date32()), ("generated_at", pa.timestamp("us"))):
+        if name in table.column_names:
+            table = table.set_column(table.column_names.index(name), name, table[name].cast(typ, safe=False))
+    return table
+
 def export_all(kpi_df):
     PathDir = os.path.dirname(CSV_EXPORT)
     if PathDir and not os.path.exists(PathDir):
         os.makedirs(PathDir, exist_ok=True)
-    kpi_df.to_csv(CSV_EXPORT, index=False)
+    pacsv.write_csv(_csv_table(kpi_df), CSV_EXPORT)
     kpi_df.to_excel(XLSX_EXPORT, index=False)
     try:
         kpi_df.to_parquet(PARQUET_EXPORT, index=False)
@@ -190,22 +257,33 @@ def generate_dashboard(kpi_df, filename=DASHBOARD_HTML):
     if kpi_df.empty:
         print("No KPI data for dashboard.")
         return
-    kpi_df = kpi_df.sort_values(['site','year_month_date'])
+    # sort once by (site, month) and slice per-site ranges instead of groupby per figure
+    sites = kpi_df['site'].to_numpy(dtype=str)
+    order = np.lexsort((kpi_df['year_month_date'].to_numpy(), sites))
+    sites = sites[order]
+    cuts = np.flatnonzero(np.r_[True, sites[1:] != sites[:-1], True])
+    x_all = kpi_df['year_month_date'].to_numpy()[order]
+    rate_all = kpi_df['completion_rate'].to_numpy()[order]
+    count_all = kpi_df['orders_count'].to_numpy()[order]
     fig = go.Figure()
-    for site, df_site in kpi_df.groupby('site'):
-        fig.add_trace(go.Scatter(x=df_site['year_month_date'], y=df_site['completion_rate'],
-                                 mode='lines+markers', name=str(site)))
+    for i0, i1 in zip(cuts[:-1], cuts[1:]):
+        fig.add_trace(go.Scatter(x=x_all[i0:i1], y=rate_all[i0:i1],
+                                 mode='lines+markers', name=sites[i0]))
     fig.update_layout(title='Completion Rate je Standort (Monat)', xaxis_title='Monat', yaxis_title='Completion Rate')
     fig2 = go.Figure()
-    for site, df_site in kpi_df.groupby('site'):
-        fig2.add_trace(go.Bar(x=df_site['year_month_date'], y=df_site['orders_count'], name=str(site)))
+    for i0, i1 in zip(cuts[:-1], cuts[1:]):
+        fig2.add_trace(go.Bar(x=x_all[i0:i1], y=count_all[i0:i1], name=sites[i0]))
     fig2.update_layout(title='Bestellanzahl je Monat / Standort', barmode='group')
-    html = "<html><head><meta charset='utf-8'></head><body>"
-    html += "<h1>BI Dashboard - KPI Export</h1>"
-    html += pio.to_html(fig, include_plotlyjs='cdn', full_html=False)
-    html += "<hr>"
-    html += pio.to_html(fig2, include_plotlyjs=False, full_html=False)
-    html += "</body></html>"
+    # figures are already built: skip validation and serialize both in parallel
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        div1 = ex.submit(pio.to_html, fig, include_plotlyjs='cdn', full_html=False, validate=False, div_id='fig1')
+        div2 = ex.submit(pio.to_html, fig2, include_plotlyjs=False, full_html=False, validate=False, div_id='fig2')
+        html = "<html><head><meta charset='utf-8'></head><body>"
+        html += "<h1>BI Dashboard - KPI Export</h1>"
+        html += div1.result()
+        html += "<hr>"
+        html += div2.result()
+        html += "</body></html>"
     outdir = os.path.dirname(filename)
     if outdir and not os.path.exists(outdir):
         os.makedirs(outdir, exist_ok=True)
@@ -216,22 +294,33 @@ def generate_dashboard(kpi_df, filename=DASHBOARD_HTML):
 # ---------------------------
 # Main
 # ---------------------------
-def main():
-    engine_src = create_engine(SOURCE_DB_URI, echo=False)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="BI & Reporting demo pipeline")
+    parser.add_argument("--skip-persist", action="store_true",
+                        help="generate demo data in memory and skip the source DB")
+    args = parser.parse_args(argv)
     engine_dw = create_engine(DW_DB_URI, echo=False)
-    with engine_src.connect() as conn:
-        res = conn.execute(text("SELECT name FROM sqlite_master WHERE type='table'"))
-        tables = [r[0] for r in res.fetchall()]
-    if not tables:
-        create_demo_source_db(engine_src)
     mit, liefer = read_additional_sources()
-    orders, production, employees = extract_data(engine_src)
+    if args.skip_persist:
+        orders, production, employees = build_demo_data()
+    else:
+        engine_src = create_engine(SOURCE_DB_URI, echo=False)
+        with engine_src.connect() as conn:
+            insp = inspect(conn)
+            missing = [t for t in ("orders", "production", "employees") if not insp.has_table(t)]
+            if len(missing) == 3:
+                create_demo_source_db(conn)
+                conn.commit()
+            elif missing:
+                raise RuntimeError(f"Source DB is incomplete, missing tables: {missing} (refusing to seed demo data over existing tables)")
+        orders, production, employees = extract_data(engine_src)
     dq = data_quality_checks(orders, production)
     if dq:
         print("Data Quality Issues:", dq)
     else:
         print("No DQ issues (basic checks).")
     kpi = transform_data(orders, production, mit, liefer)
+    kpi = downcast_kpis(kpi)
     load_to_dw(engine_dw, kpi)
     export_all(kpi)
     generate_dashboard(kpi)